@@ -5,33 +5,32 @@
 
 import sqlite3
 import pandas as pd
-from database import read_from_db
+from database import get_offline_summary, get_offline_rows
 
 
 # ===========================================
 # FUNCTION 1: Check offline stations
 # ===========================================
-def check_offline_stations():
+def check_offline_stations(conn=None):
     """
     Checks what percentage of stations are offline.
     If more than 10% are offline, it raises an alert.
     This is like a "check engine" light for the charging network.
+    Pass an open connection to reuse it (e.g. from the dashboard).
     """
     
     print("\n🚨 Checking station health...")
     
-    # Connect to database
-    conn = sqlite3.connect("charging_stations.db")
+    # Connect to database (unless we were given a connection to reuse)
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect("charging_stations.db")
     
-    # Read all stations
-    df = read_from_db(conn)
+    # Count all stations and offline stations (from the latest health snapshot)
+    total_count, offline_count = get_offline_summary(conn)
     
-    # Count offline stations
-    offline_count = df["is_offline"].sum()
-    total_count = len(df)
-    
-    # Calculate percentage
-    offline_pct = (offline_count / total_count) * 100
+    # Calculate percentage (0% if the database is still empty)
+    offline_pct = (offline_count / total_count) * 100 if total_count else 0.0
     
     print(f"   Total stations: {total_count}")
     print(f"   Offline stations: {offline_count}")
@@ -57,7 +56,8 @@ def check_offline_stations():
         # All good!
         print(f"\n✅ System healthy: {offline_pct:.1f}% offline (below {threshold}% threshold)")
     
-    conn.close()
+    if own_conn:
+        conn.close()
     
     return offline_pct
 
@@ -65,19 +65,22 @@ def check_offline_stations():
 # ===========================================
 # FUNCTION 2: List offline stations
 # ===========================================
-def list_offline_stations():
+def list_offline_stations(conn=None):
     """
-    Returns a list of all offline stations with their details.
+    Returns a list of offline stations (stalest first, up to 1000) with their details.
     Useful for the dashboard and for debugging.
+    Pass an open connection to reuse it (e.g. from the dashboard).
     """
     
-    conn = sqlite3.connect("charging_stations.db")
-    df = read_from_db(conn)
-    
-    # Filter for offline stations only
-    offline_df = df[df["is_offline"] == True]
+    # Connect to database (unless we were given a connection to reuse)
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect("charging_stations.db")
+    # Ask SQL for the offline stations only (up to 1000 of them)
+    offline_df = get_offline_rows(conn, limit=1000)
     
-    conn.close()
+    if own_conn:
+        conn.close()
     
     return offline_df
 
@@ -7,7 +7,8 @@ import streamlit as st  # Streamlit makes web apps easy
 import pandas as pd
 import sqlite3
 import plotly.express as px  # For beautiful charts
-from database import read_from_db
+import pydeck as pdk  # For fast maps with lots of points
+from database import read_from_db, read_columns, get_kpis, get_offline_rows, get_operator_counts
 import time
 
 
@@ -26,32 +27,109 @@ st.markdown("### Real-time monitoring of electric vehicle charging infrastructur
 
 
 # ===========================================
-# LOAD DATA FROM DATABASE (NO CACHING - ALWAYS FRESH)
+# LOAD DATA FROM DATABASE (CACHED FOR 10 SECONDS)
 # ===========================================
-def load_data():
-    """Load stations from database - ALWAYS fresh, no caching"""
+# Each loader asks SQLite for just what it needs (a few numbers or a
+# small table), over one shared connection. Results are cached for
+# 10 seconds - the same as the auto-refresh - so reruns in between
+# reuse them instead of re-querying.
+
+@st.cache_resource
+def get_conn():
+    """
+    Open ONE database connection and share it across every rerun,
+    instead of connecting again for each query.
+    """
+    conn = sqlite3.connect("charging_stations.db", check_same_thread=False, uri=True)
+    conn.execute("PRAGMA mmap_size=268435456")  # Read the file through memory-mapping (256 MB)
+    conn.execute("PRAGMA cache_size=-65536")    # Keep up to 64 MB of pages in memory
+    conn.execute("PRAGMA query_only=ON")        # The dashboard only reads
+    return conn
+
+# Columns needed for the data preview and the map (and its hover labels)
+PREVIEW_COLUMNS = ["name", "city", "operator_clean", "days_since_update"]
+MAP_COLUMNS = ["name", "latitude", "longitude", "is_offline", "city", "operator_clean", "days_since_update"]
+
+# Decimals kept for map coordinates (5 decimals = about 1m)
+MAP_COORD_DECIMALS = 5
+
+# Above this many stations, the map also shows a density layer
+MAP_DENSITY_THRESHOLD = 100_000
+
+@st.cache_data(ttl=10)
+def load_kpis():
+    """Get the headline numbers (total, offline, Tesla, average age)"""
     try:
-        conn = sqlite3.connect("charging_stations.db")
-        df = read_from_db(conn)
-        conn.close()
-        return df
+        conn = get_conn()
+        kpis = get_kpis(conn)
+        return kpis
     except Exception as e:
         st.warning(f"⚠️ Could not load data: {e}")
+        return {"total": 0, "offline": 0, "avg_days": None, "tesla": 0}
+
+@st.cache_data(ttl=10)
+def load_map_data():
+    """Load only the columns the map needs"""
+    try:
+        conn = get_conn()
+        df = read_columns(conn, MAP_COLUMNS)
+        
+        # Every point is sent to the browser as JSON, so keep it small:
+        # - stations without GPS coordinates can't be drawn (and NaN isn't valid JSON)
+        # - 5 decimals is about 1m - plenty for a map. We keep float64 on purpose:
+        #   float32 values print with MORE digits in JSON (31.2 -> 31.200000762939453)
+        # - 0/1 is shorter than false/true
+        df = df.dropna(subset=["latitude", "longitude"])
+        df[["latitude", "longitude"]] = df[["latitude", "longitude"]].astype("float64").round(MAP_COORD_DECIMALS)
+        df["is_offline"] = df["is_offline"].astype("int8")
+        return df
+    except Exception as e:
+        st.warning(f"⚠️ Could not load map data: {e}")
+        return pd.DataFrame(columns=MAP_COLUMNS)
+
+@st.cache_data(ttl=10)
+def load_offline_rows():
+    """Load the offline stations table"""
+    try:
+        conn = get_conn()
+        offline_df = get_offline_rows(conn)
+        return offline_df
+    except Exception as e:
         return pd.DataFrame()
 
+@st.cache_data(ttl=10)
+def load_operator_counts():
+    """Load the number of stations per operator"""
+    try:
+        conn = get_conn()
+        operator_counts = get_operator_counts(conn)
+        return operator_counts
+    except Exception as e:
+        return pd.DataFrame(columns=["Operator", "Count"])
+
+@st.cache_data(ttl=10)
+def load_preview_rows():
+    """Load the first 20 stations for the data preview"""
+    try:
+        conn = get_conn()
+        preview_df = read_from_db(conn, columns=PREVIEW_COLUMNS, limit=20)
+        return preview_df
+    except Exception as e:
+        return pd.DataFrame(columns=PREVIEW_COLUMNS)
+
 def get_stats():
     """Get statistics from database"""
     try:
-        conn = sqlite3.connect("charging_stations.db")
+        conn = get_conn()
         from database import get_stats
         stats = get_stats(conn)
-        conn.close()
         return stats
     except Exception as e:
         return {}
 
-# Load fresh data every time
-df = load_data()
+# Check whether the ETL has loaded anything yet (cheap - a single SQL query)
+has_data = load_kpis()["total"] > 0
+st.session_state["has_data"] = has_data
 
 
 # ===========================================
@@ -65,108 +143,139 @@ with col_refresh1:
     st.info("💡 Dashboard auto-refreshes every 10 seconds while data is being scraped")
 with col_refresh2:
     if st.button("🔄 Refresh Now"):
+        st.cache_data.clear()  # Skip the 10 second cache
         st.rerun()
 
-# Create 4 columns for metrics
-col1, col2, col3, col4 = st.columns(4)
-
-with col1:
-    total_stations = len(df)
-    st.metric(
-        label="Total Stations",
-        value=f"{total_stations:,}",
-        help="Total number of charging stations in the database"
-    )
+# A "fragment" is a piece of the page that reruns on its own.
+# The metrics refresh every 10 seconds without redrawing the map.
+@st.fragment(run_every=10)
+def show_key_metrics():
+    kpis = load_kpis()
+    total_stations = kpis["total"]
+    
+    # First data just arrived - rerun the whole page so the map and tables appear
+    if total_stations > 0 and not st.session_state.get("has_data"):
+        st.rerun()
+    
+    # Create 4 columns for metrics
+    col1, col2, col3, col4 = st.columns(4)
 
-with col2:
-    if len(df) > 0:
-        offline_count = df["is_offline"].sum()
-        offline_pct = (offline_count/len(df))*100
+    with col1:
         st.metric(
-            label="Offline Stations",
-            value=offline_count,
-            delta=f"{offline_pct:.1f}% of network",
-            delta_color="inverse",  # Red if high
-            help="Stations that haven't been updated in 90+ days"
+            label="Total Stations",
+            value=f"{total_stations:,}",
+            help="Total number of charging stations in the database"
         )
-    else:
-        st.metric(label="Offline Stations", value="—")
 
-with col3:
-    if len(df) > 0:
-        tesla_count = (df["operator_clean"] == "Tesla").sum()
-        st.metric(
-            label="Tesla Stations",
-            value=f"{tesla_count:,}",
-            help="Charging stations operated by Tesla"
-        )
-    else:
-        st.metric(label="Tesla Stations", value="—")
+    with col2:
+        if total_stations > 0:
+            offline_count = kpis["offline"]
+            offline_pct = (offline_count/total_stations)*100
+            st.metric(
+                label="Offline Stations",
+                value=offline_count,
+                delta=f"{offline_pct:.1f}% of network",
+                delta_color="inverse",  # Red if high
+                help="Stations that haven't been updated in 90+ days"
+            )
+        else:
+            st.metric(label="Offline Stations", value="—")
+
+    with col3:
+        if total_stations > 0:
+            st.metric(
+                label="Tesla Stations",
+                value=f"{kpis['tesla']:,}",
+                help="Charging stations operated by Tesla"
+            )
+        else:
+            st.metric(label="Tesla Stations", value="—")
+
+    with col4:
+        if kpis["avg_days"] is not None:
+            st.metric(
+                label="Avg. Days Since Update",
+                value=f"{kpis['avg_days']:.1f} days",
+                help="Average age of station information"
+            )
+        else:
+            st.metric(label="Avg. Days Since Update", value="—")
 
-with col4:
-    if len(df) > 0:
-        avg_days = df["days_since_update"].mean()
-        st.metric(
-            label="Avg. Days Since Update",
-            value=f"{avg_days:.1f} days",
-            help="Average age of station information"
-        )
+    # ===========================================
+    # PROGRESS INDICATOR
+    # ===========================================
+    if total_stations > 0:
+        st.success(f"✅ **{total_stations:,} stations loaded!** Last updated: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}")
     else:
-        st.metric(label="Avg. Days Since Update", value="—")
+        st.warning("⏳ **No data yet.** ETL pipeline is still scraping... Refresh this page in a moment!")
 
-
-# ===========================================
-# PROGRESS INDICATOR
-# ===========================================
-if len(df) > 0:
-    st.success(f"✅ **{len(df):,} stations loaded!** Last updated: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}")
-else:
-    st.warning("⏳ **No data yet.** ETL pipeline is still scraping... Refresh this page in a moment!")
+show_key_metrics()
 
 
 # ===========================================
 # DISPLAY MAP
 # ===========================================
-if len(df) > 0:
+# No run_every here: the map is only rebuilt on a full page refresh,
+# so the auto-refresh never redraws every station.
+@st.fragment
+def show_map():
     st.markdown("## 🗺️ Station Locations")
 
-    # Create a map using Plotly
-    fig = px.scatter_mapbox(
+    # Only the map needs per-station rows
+    df = load_map_data()
+
+    # Create a map using pydeck - it draws points on the GPU (WebGL),
+    # so it stays smooth even with hundreds of thousands of stations
+    station_layer = pdk.Layer(
+        "ScatterplotLayer",
         df,
-        lat="latitude",           # Column with latitude
-        lon="longitude",          # Column with longitude
-        color="is_offline",       # Color by offline status
-        color_discrete_map={True: "red", False: "green"},  # Red = offline, Green = online
-        hover_name="name",        # Show name on hover
-        hover_data=["city", "operator_clean", "days_since_update"],  # Show extra info on hover
-        zoom=3,                   # Zoom level (3 = China view)
-        height=500,               # Height of the map
-        title="Charging Station Distribution"
+        get_position=["longitude", "latitude"],                   # Columns with GPS coordinates
+        get_fill_color="is_offline ? [255, 0, 0] : [0, 200, 0]",  # Red = offline, Green = online
+        radius_min_pixels=3,      # Keep points visible when zoomed out
+        radius_max_pixels=10,     # ...and small when zoomed in
+        pickable=True             # Needed for the hover tooltip
     )
+    layers = [station_layer]
+
+    # With lots of stations the points pile on top of each other,
+    # so add a density layer (hexagons) underneath.
+    # It only needs the coordinates - sending the other columns would
+    # ship every station's details to the browser a second time
+    if len(df) > MAP_DENSITY_THRESHOLD:
+        density_layer = pdk.Layer(
+            "HexagonLayer",
+            df[["longitude", "latitude"]],
+            get_position=["longitude", "latitude"],
+            radius=20000,         # Hexagon size in meters
+            opacity=0.3
+        )
+        layers.insert(0, density_layer)
 
-    # Set map style
-    fig.update_layout(
-        mapbox_style="open-street-map",  # Free map style
-        margin={"r":0,"t":30,"l":0,"b":0}  # Remove margins
+    deck = pdk.Deck(
+        layers=layers,
+        initial_view_state=pdk.ViewState(latitude=35, longitude=105, zoom=3),  # China view
+        map_style=pdk.map_styles.CARTO_ROAD,  # Free map style
+        tooltip={"text": "{name}\n{city} · {operator_clean}\n{days_since_update} days since update"}
     )
 
     # Display the map
-    st.plotly_chart(fig, use_container_width=True)
+    st.caption("Charging Station Distribution (🔴 offline, 🟢 online)")
+    st.pydeck_chart(deck, use_container_width=True, height=500)
 
 
+# The tables are small SQL results, so they refresh with the metrics
+@st.fragment(run_every=10)
+def show_tables():
     # ===========================================
     # DISPLAY OFFLINE STATIONS TABLE
     # ===========================================
     st.markdown("## ⚠️ Offline Stations")
 
-    offline_df = df[df["is_offline"] == True]
+    offline_df = load_offline_rows()
 
     if len(offline_df) > 0:
         # Show a data table
-        st.dataframe(
-            offline_df[["name", "city", "operator_clean", "days_since_update", "last_updated"]],
-            use_container_width=True
-        )
+        st.dataframe(offline_df, use_container_width=True)
     else:
         st.success("✅ No offline stations detected!")
 
@@ -177,8 +286,7 @@ if len(df) > 0:
     st.markdown("## 🏢 Operator Breakdown")
 
     # Count stations by operator
-    operator_counts = df["operator_clean"].value_counts().reset_index()
-    operator_counts.columns = ["Operator", "Count"]
+    operator_counts = load_operator_counts()
 
     # Create a bar chart
     fig2 = px.bar(
@@ -193,25 +301,13 @@ if len(df) > 0:
 
     # Show data preview
     st.markdown("## 📋 Data Preview")
-    st.dataframe(
-        df[["name", "city", "operator_clean", "days_since_update"]].head(20),
-        use_container_width=True
-    )
+    st.dataframe(load_preview_rows(), use_container_width=True)
+
 
+if has_data:
+    show_map()
+    show_tables()
 else:
     st.markdown("---")
     st.info("⏳ **Waiting for data...** The ETL pipeline is currently scraping charging stations from the API. This may take several minutes.")
     st.info("📌 **Tip:** Keep this page open and it will auto-refresh every 10 seconds to show new data as it arrives.")
-
-# Auto-refresh every 10 seconds
-import streamlit.components.v1 as components
-components.html(
-    """
-    <script>
-    setTimeout(function() {
-        window.location.reload();
-    }, 10000);
-    </script>
-    """,
-    height=0
-)
\ No newline at end of file
@@ -7,6 +7,40 @@ import sqlite3  # Tool to work with SQLite databases
 import pandas as pd  # Still need pandas to work with tables
 import os  # Tool to check if files exist
 
+# Optional: pyarrow gives compact, Arrow-backed columns when reading from SQLite
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Optional: DuckDB runs analytics queries on the Parquet copy of the table
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Columnar copy of the stations table, rewritten on every ETL load
+PARQUET_FILE = "stations.parquet"
+
+# Columns of the stations table, in the same order as CREATE TABLE
+STATION_COLUMNS = [
+    "id", "name", "latitude", "longitude", "address",
+    "operator_clean", "city", "is_offline", "days_since_update", "last_updated"
+]
+
+# Text columns with only a few distinct values - kept as pandas "category"
+# (stored once per value, compared as small integer codes)
+CATEGORY_COLUMNS = ["operator_clean", "city"]
+
+# Network health in one row - used for the v_health view and its snapshots
+HEALTH_QUERY = """
+    SELECT COUNT(*) AS total,
+           COALESCE(SUM(is_offline), 0) AS offline,
+           AVG(days_since_update) AS avg_age,
+           COALESCE(SUM(operator_clean = 'Tesla'), 0) AS tesla
+    FROM stations
+"""
+
 
 # ===========================================
 # FUNCTION 1: Initialize the database
@@ -23,6 +57,14 @@ def init_db():
     # Connect to the database file (creates it if it doesn't exist)
     conn = sqlite3.connect("charging_stations.db")
     
+    # Speed settings for bulk writes:
+    # - WAL lets the dashboard keep reading while the ETL is writing
+    # - synchronous=NORMAL is safe with WAL and avoids a disk flush on every commit
+    # - temp_store=MEMORY keeps temporary tables/indexes in RAM
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    
     # Create a cursor to execute SQL commands
     cursor = conn.cursor()
     
@@ -52,6 +94,28 @@ def init_db():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_offline ON stations(is_offline)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_lat_lon ON stations(latitude, longitude)')
     
+    # "Covering" index for the offline stations table: it holds every column that
+    # query needs, so SQLite never has to look the rows up in the table itself
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_offline_cover
+        ON stations(is_offline, days_since_update, operator_clean, city, name, last_updated)
+    ''')
+    
+    # A "view" is a saved query - v_health always shows the current network health
+    cursor.execute(f"CREATE VIEW IF NOT EXISTS v_health AS {HEALTH_QUERY}")
+    
+    # A tiny table holding a copy of v_health after every ETL load, so the
+    # dashboard and alerts read one row instead of rescanning every station
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS health_snapshot (
+            ts TEXT PRIMARY KEY,           -- When the snapshot was taken (UTC)
+            total INTEGER,                 -- Number of stations
+            offline INTEGER,               -- Number of offline stations
+            avg_age REAL,                  -- Average days since update
+            tesla INTEGER                  -- Number of Tesla stations
+        )
+    ''')
+    
     # Save the changes
     conn.commit()
     
@@ -72,19 +136,37 @@ def load_to_db(df, conn):
     
     print("\n📥 Loading data into database...")
     
-    # Get the list of station IDs we're about to insert
-    ids = df["id"].tolist()
+    # Keep only the table's columns, and turn pandas values (timestamps, NaN/NaT)
+    # into plain Python values that SQLite understands
+    rows_df = df[STATION_COLUMNS].copy()
+    if pd.api.types.is_datetime64_any_dtype(rows_df["last_updated"]):
+        # (Arrow-backed timestamps add fractions of a second - cut them off)
+        rows_df["last_updated"] = rows_df["last_updated"].dt.strftime("%Y-%m-%d %H:%M:%S").str.slice(0, 19)
+    rows_df = rows_df.astype(object).where(rows_df.notna(), None)
+    rows = rows_df.itertuples(index=False, name=None)
     
-    # Delete any existing records with these IDs (this is called "upsert" - update or insert)
-    # We do this so we don't get duplicate entries when we run the pipeline again
-    placeholders = ','.join('?' * len(ids))  # Creates "?, ?, ?, ..." for SQL
-    conn.execute(f"DELETE FROM stations WHERE id IN ({placeholders})", ids)
+    # "Upsert" - insert new stations, update the ones we already have
+    # This way we don't get duplicate entries when we run the pipeline again
+    columns = ", ".join(STATION_COLUMNS)
+    placeholders = ", ".join("?" * len(STATION_COLUMNS))  # Creates "?, ?, ?, ..." for SQL
+    updates = ", ".join(f"{col} = excluded.{col}" for col in STATION_COLUMNS if col != "id")
     
-    # Now insert the new data
-    # to_sql() is a pandas function that writes a DataFrame to SQL
-    df.to_sql("stations", conn, if_exists="append", index=False)
+    # One transaction for all rows ("with conn" commits at the end)
+    with conn:
+        conn.executemany(
+            f"INSERT INTO stations ({columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}",
+            rows
+        )
     
-    # Save the changes
+    # Save a health snapshot (also builds up a history for trend charts)
+    # and refresh the query planner's statistics so it picks the best index
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO health_snapshot "
+            "SELECT datetime('now'), total, offline, avg_age, tesla FROM v_health"
+        )
+    conn.execute("ANALYZE stations")
     conn.commit()
     
     # Print database stats
@@ -94,24 +176,36 @@ def load_to_db(df, conn):
     
     print(f"   ✅ Loaded {len(df)} records to database!")
     print(f"   📊 Total records in database: {total_records}")
+    
+    # Mirror the whole table to Parquet for the dashboard's analytics
+    export_to_parquet(conn)
 
 
 # ===========================================
 # FUNCTION 3: Read data from the database
 # ===========================================
-def read_from_db(conn):
+def read_from_db(conn, columns=None, limit=None):
     """
     Reads all stations from the database and returns them as a DataFrame.
-    Useful for the dashboard later.
+    Pass a list of columns to only read the ones you need (e.g. for the map),
+    and a limit to only read the first few rows (e.g. for a preview).
     """
     
     # SQL query to select all rows from the stations table
-    query = "SELECT * FROM stations"
+    column_list = ", ".join(columns) if columns else "*"
+    query = f"SELECT {column_list} FROM stations"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
     
-    # Use pandas to run the query and return a DataFrame
-    df = pd.read_sql_query(query, conn)
+    # Use pandas to run the query on OUR connection and return a DataFrame.
+    # Columns are Arrow-backed when pyarrow is installed (compact, real missing values).
+    # Note: don't read the file through a second SQLite engine (e.g. connectorx) while
+    # this process holds it open - SQLite's locks are per process, so the two engines
+    # don't see each other's writes and can corrupt the WAL file.
+    dtype_backend = "pyarrow" if pyarrow is not None else "numpy_nullable"
+    df = pd.read_sql_query(query, conn, dtype_backend=dtype_backend)
     
-    return df
+    return to_categories(df)
 
 
 # ===========================================
@@ -149,6 +243,181 @@ def get_stats(conn):
     return stats
 
 
+# ===========================================
+# FUNCTION 5: Get key metrics for dashboard
+# ===========================================
+def get_kpis(conn):
+    """
+    Gets the dashboard's headline numbers.
+    Reads the latest health snapshot (one row, saved by load_to_db) instead of
+    scanning the stations table. Falls back to the live numbers if there is
+    no snapshot yet.
+    """
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+            SELECT total, offline, avg_age, tesla
+            FROM health_snapshot
+            ORDER BY ts DESC
+            LIMIT 1
+        """)
+        row = cursor.fetchone()
+    except sqlite3.OperationalError:
+        # Database created before snapshots existed
+        row = None
+    
+    if row is None:
+        cursor.execute(HEALTH_QUERY)
+        row = cursor.fetchone()
+    
+    total, offline, avg_days, tesla = row
+    
+    return {
+        "total": total,
+        "offline": offline,
+        "avg_days": avg_days,  # None when the table is empty
+        "tesla": tesla
+    }
+
+
+# ===========================================
+# FUNCTION 6: Count offline stations
+# ===========================================
+def get_offline_summary(conn):
+    """
+    Returns (total stations, offline stations) for the alert check.
+    Comes from the same health snapshot as the dashboard (see get_kpis).
+    """
+    kpis = get_kpis(conn)
+    
+    return kpis["total"], kpis["offline"]
+
+
+# ===========================================
+# FUNCTION 7: Get offline stations
+# ===========================================
+def get_offline_rows(conn, limit=500):
+    """
+    Returns the offline stations (stalest first), up to `limit` rows.
+    Answered entirely from the idx_offline_cover index (no table lookups).
+    """
+    query = """
+        SELECT name, city, operator_clean, days_since_update, last_updated
+        FROM stations
+        WHERE is_offline = 1
+        ORDER BY days_since_update DESC
+        LIMIT ?
+    """
+    
+    return pd.read_sql_query(query, conn, params=(limit,))
+
+
+# ===========================================
+# FUNCTION 8: Count stations by operator
+# ===========================================
+def get_operator_counts(conn):
+    """
+    Counts stations per operator in SQL (answered from the Parquet copy
+    with DuckDB, or from SQLite's operator index).
+    Returns a small DataFrame with "Operator" and "Count" columns.
+    """
+    query = """
+        SELECT operator_clean AS Operator, COUNT(*) AS Count
+        FROM stations
+        GROUP BY operator_clean
+        ORDER BY Count DESC
+    """
+    
+    # DuckDB on the Parquet copy is fastest for a GROUP BY; SQLite otherwise
+    operator_counts = query_parquet(query)
+    if operator_counts is not None:
+        return operator_counts
+    
+    return pd.read_sql_query(query, conn)
+
+
+# ===========================================
+# FUNCTION 9: Mirror the table to Parquet
+# ===========================================
+def export_to_parquet(conn, path=PARQUET_FILE):
+    """
+    Writes the whole stations table to a Parquet file (a column-by-column format).
+    Queries that only need a few columns can then skip reading the rest.
+    """
+    
+    try:
+        # Write to a temporary file first, then swap it in, so the dashboard
+        # never reads a half-written file
+        temp_path = path + ".tmp"
+        
+        # Read the table through the connection we were given, so the copy
+        # always matches what was just committed on it
+        df = to_categories(pd.read_sql_query("SELECT * FROM stations", conn, dtype_backend="pyarrow"))
+        df.to_parquet(temp_path, compression="zstd", index=False)
+        os.replace(temp_path, path)
+        print(f"   🗂️  Mirrored table to {path}")
+    except ImportError:
+        print("   ⚠️  pyarrow not installed, skipping Parquet export")
+
+
+# ===========================================
+# FUNCTION 10: Query the Parquet copy with DuckDB
+# ===========================================
+def query_parquet(query, params=None):
+    """
+    Runs a SQL query with DuckDB on the Parquet copy of the table
+    (refer to it as "stations", just like in SQLite).
+    Returns None if DuckDB or the Parquet file isn't available,
+    so the caller can ask SQLite instead.
+    """
+    
+    if duckdb is None or not os.path.exists(PARQUET_FILE):
+        return None
+    
+    duck = duckdb.connect()  # In-memory DuckDB, only used to read the file
+    try:
+        duck.execute(f"CREATE VIEW stations AS SELECT * FROM read_parquet('{PARQUET_FILE}')")
+        return duck.execute(query, params or []).fetch_df()
+    finally:
+        duck.close()
+
+
+# ===========================================
+# FUNCTION 11: Read a few columns for every station
+# ===========================================
+def read_columns(conn, columns):
+    """
+    Reads only the given columns for every station (e.g. for the map).
+    Uses the Parquet copy when possible - DuckDB only reads those columns from disk.
+    """
+    
+    query = f"SELECT {', '.join(columns)} FROM stations"
+    
+    df = query_parquet(query)
+    if df is not None:
+        return to_categories(df)
+    
+    return read_from_db(conn, columns=columns)
+
+
+# ===========================================
+# HELPER: Use categories for repeated text
+# ===========================================
+def to_categories(df):
+    """
+    Converts the low-cardinality text columns (operator, city) to pandas "category".
+    Each name is stored once, so the table uses far less memory, and
+    filters / group-bys compare integer codes instead of strings.
+    """
+    
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    
+    return df
+
+
 # ===========================================
 # TEST THE DATABASE FUNCTIONS
 # ===========================================
@@ -183,5 +452,9 @@ if __name__ == "__main__":
     print("\n📊 Database statistics:")
     print(stats)
     
+    # Get dashboard KPIs
+    print("\n📈 Dashboard KPIs:")
+    print(get_kpis(conn))
+    
     # Close the connection
     conn.close()
\ No newline at end of file
@@ -6,10 +6,41 @@
 # IMPORTS - These are like loading tools into your workshop
 import requests  # Tool to download data from the internet
 import pandas as pd  # Tool to work with tables of data (like Excel)
-import time  # Tool to add delays (so we don't spam servers)
-from database import init_db, load_to_db
-import json
+from requests.adapters import HTTPAdapter  # Lets us keep more connections open at once
+from concurrent.futures import ThreadPoolExecutor  # Tool to download several pages at once
+import time  # Tool to add delays (when the server asks us to slow down)
+from database import init_db, load_to_db, to_categories
+import numpy as np  # Tool for fast math on whole columns at once
 import os
+import re  # Tool for pattern matching in text
+
+# City boundary files used for offline reverse geocoding
+# Polygons: e.g. GADM admin-2 for China (needs a "NAME_2" column)
+# Centroids: a CSV with "city", "latitude", "longitude" columns (fallback)
+# Without either file, the reverse_geocoder package's built-in city list is used
+CITY_POLYGONS_FILE = "china_cities.geojson"
+CITY_CENTROIDS_FILE = "china_cities.csv"
+
+# API pagination settings
+PAGE_SIZE = 500           # Stations per request (API max)
+PARALLEL_REQUESTS = 8     # Pages downloaded at the same time
+MAX_RETRIES = 5           # Attempts per page when the API says "too many requests"
+
+# API fields we keep, and the column names we give them
+# (flattened by pd.json_normalize, e.g. station["AddressInfo"]["Title"] -> "AddressInfo_Title")
+API_FIELDS = {
+    "ID": "id",                                 # Unique ID for each station
+    "AddressInfo_Title": "name",                # Name of the station
+    "AddressInfo_Latitude": "latitude",         # GPS coordinate
+    "AddressInfo_Longitude": "longitude",       # GPS coordinate
+    "AddressInfo_AddressLine1": "address",      # Street address
+    "OperatorInfo_Title": "operator",           # Who runs this station
+    "DateLastConfirmed": "last_updated"         # When was this info last checked?
+}
+
+# Operators we track by name - anything else is grouped as "Other"
+OPERATOR_PATTERN = re.compile(r"(tesla|bp|shell)")
+OPERATOR_NAMES = {"tesla": "Tesla", "bp": "BP", "shell": "Shell"}
 
 # ===========================================
 # FUNCTION 1: EXTRACT - Download the data with pagination
@@ -17,7 +48,8 @@ import os
 def extract_charging_stations(max_pages=None):
     """
     This function downloads charging station data from Open Charge Map API.
-    It automatically handles pagination to get ALL stations in China.
+    It automatically handles pagination to get ALL stations in China,
+    downloading several pages at the same time.
     """
     
     # The web address where the data lives
@@ -31,28 +63,37 @@ def extract_charging_stations(max_pages=None):
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
     }
     
-    # Create an empty list to store ALL stations across all pages
-    all_stations = []
-    skip = 0  # Start from the first station
-    page = 0
+    # One shared session re-uses connections instead of opening a new one per page
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.headers.update(headers)
     
-    while True:
-        page += 1
-        print(f"📥 Fetching page {page}... (offset: {skip})")
-        
+    # Function to download one page of stations, starting at `skip`
+    def fetch_page(skip):
         # What we're asking for:
         params = {
             "output": "json",           # Give me data in JSON format (structured text)
             "countrycode": "CN",        # Only stations in China
-            "maxresults": 500,          # Get 500 per request (API max)
+            "maxresults": PAGE_SIZE,    # Get 500 per request (API max)
             "compact": "true",          # Keep the response small
             "verbose": "false",         # Don't give extra details
             "skip": skip,               # Skip previous results (pagination)
             "key": api_key              # Include the API key
         }
         
-        # Send the request and get the response
-        response = requests.get(url, params=params, headers=headers, timeout=30)
+        for attempt in range(MAX_RETRIES):
+            # Send the request and get the response
+            response = session.get(url, params=params, timeout=30)
+            
+            # 429 = "Too Many Requests" - wait a bit and try again (1s, 2s, 4s, ...)
+            if response.status_code == 429:
+                retry_after = response.headers.get("Retry-After", "")
+                wait = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+                print(f"   ⏳ Rate limited at offset {skip}, retrying in {wait}s...")
+                time.sleep(wait)
+                continue
+            break
         
         # Check if the request was successful
         if response.status_code != 200:
@@ -63,51 +104,164 @@ def extract_charging_stations(max_pages=None):
         # Check if response has content
         if not response.text:
             print("❌ API returned empty response")
-            break
+            return []
         
         # Convert the response to Python-readable format
-        data = response.json()
-        
-        # If no data returned, we've reached the end
-        if len(data) == 0:
-            print(f"✅ Reached the end of data at page {page}")
-            break
-        
-        print(f"   ✅ Got {len(data)} stations from this page")
-        
-        # Loop through each station in the data
-        for station in data:
-            # Extract the information we care about
-            station_info = {
-                "id": station["ID"],  # Unique ID for each station
-                "name": station["AddressInfo"]["Title"],  # Name of the station
-                "latitude": station["AddressInfo"]["Latitude"],  # GPS coordinate
-                "longitude": station["AddressInfo"]["Longitude"],  # GPS coordinate
-                "address": station["AddressInfo"]["AddressLine1"],  # Street address
-                "operator": station.get("OperatorInfo", {}).get("Title", "Unknown"),
-                # Who runs this station (Tesla, government, etc.)
-                "last_updated": station.get("DateLastConfirmed") or station.get("DateLastStatusUpdate") or "Unknown"
-                # When was this info last checked?
-            }
+        return response.json()
+    
+    # Create an empty list to store one table per page
+    page_frames = []
+    page = 0
+    done = False
+    
+    # Download several pages at the same time instead of one after another
+    with ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS) as executor:
+        while not done:
+            batch_size = PARALLEL_REQUESTS
+            if max_pages:
+                batch_size = min(batch_size, max_pages - page)
             
-            # Add this station to our list
-            all_stations.append(station_info)
-        
-        # Move to next page
-        skip += 500
+            offsets = [(page + i) * PAGE_SIZE for i in range(batch_size)]
+            print(f"📥 Fetching pages {page + 1}-{page + batch_size}... (offset: {offsets[0]})")
+            
+            # map() gives the results back in page order
+            for data in executor.map(fetch_page, offsets):
+                page += 1
+                
+                # If no data returned, we've reached the end
+                if len(data) == 0:
+                    print(f"✅ Reached the end of data at page {page}")
+                    done = True
+                    break
+                
+                print(f"   ✅ Got {len(data)} stations from page {page}")
+                
+                # Flatten the nested JSON into a table in one call
+                # (AddressInfo -> Title becomes the "AddressInfo_Title" column)
+                # Fields missing from this page become empty columns
+                page_df = pd.json_normalize(data, sep="_")
+                page_frames.append(page_df.reindex(columns=[*API_FIELDS, "DateLastStatusUpdate"]))
+                
+                # A page that isn't full is the last one
+                if len(data) < PAGE_SIZE:
+                    print(f"✅ Reached the end of data at page {page}")
+                    done = True
+                    break
+            
+            # Optional: limit pages for testing (remove or set to None for all data)
+            if not done and max_pages and page >= max_pages:
+                print(f"⚠️  Stopped at page {page} (max_pages limit reached)")
+                done = True
+    
+    # Stick all the pages together into one pandas DataFrame (a table)
+    if not page_frames:
+        return pd.DataFrame(columns=list(API_FIELDS.values()))
+    df = pd.concat(page_frames, ignore_index=True).rename(columns=API_FIELDS)
+    
+    # Who runs this station (Tesla, government, etc.)
+    df["operator"] = df["operator"].fillna("Unknown")
+    
+    # When was this info last checked? Use the status update date if never confirmed
+    df["last_updated"] = (
+        df["last_updated"]
+        .fillna(df["DateLastStatusUpdate"])
+        .fillna("Unknown")
+    )
+    
+    # Keep only the columns we care about
+    df = df[list(API_FIELDS.values())]
+    
+    # Store IDs as real integers (not Python objects) so de-duplicating is fast
+    df["id"] = pd.to_numeric(df["id"], downcast="integer")
+    
+    return df
+
+
+# ===========================================
+# HELPER: Offline reverse geocoding
+# ===========================================
+def lookup_cities(lats, lons):
+    """
+    Finds the city for arrays of coordinates in one go, without calling any web API.
+    - If city polygons are available, each point is matched to the city it falls inside
+    - Otherwise, each point is matched to the nearest city centre
+      (from CITY_CENTROIDS_FILE, or the geonames list bundled with reverse_geocoder)
+    Returns an array of city names ("Unknown" when no match is found).
+    """
+    
+    # Option A: spatial join against city polygons (most accurate)
+    if os.path.exists(CITY_POLYGONS_FILE):
+        try:
+            import geopandas as gpd
+            
+            cities = gpd.read_file(CITY_POLYGONS_FILE)[["NAME_2", "geometry"]].to_crs("EPSG:4326")
+            points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lons, lats), crs="EPSG:4326")
+            joined = gpd.sjoin(points, cities, how="left", predicate="within")
+            
+            # A point exactly on a border can match two cities - keep the first
+            joined = joined[~joined.index.duplicated(keep="first")]
+            return joined["NAME_2"].reindex(points.index).fillna("Unknown").to_numpy(dtype=object)
+        except ImportError:
+            print("   ⚠️  geopandas not installed, falling back to nearest city centre")
+    
+    # Option B: nearest city centre from our own list, using a KD-tree
+    if os.path.exists(CITY_CENTROIDS_FILE):
+        from scipy.spatial import cKDTree
         
-        # Optional: limit pages for testing (remove or set to None for all data)
-        if max_pages and page >= max_pages:
-            print(f"⚠️  Stopped at page {page} (max_pages limit reached)")
-            break
+        centroids = pd.read_csv(CITY_CENTROIDS_FILE)
+        tree = cKDTree(centroids[["latitude", "longitude"]].to_numpy())
+        _, nearest = tree.query(np.column_stack([lats, lons]), k=1)
+        return centroids["city"].to_numpy(dtype=object)[nearest]
+    
+    # Option C: nearest city from reverse_geocoder's built-in list (~150k places
+    # worldwide, searched with a C KD-tree). mode=2 splits the work across CPU cores.
+    try:
+        import reverse_geocoder as rg
         
-        # Be nice to the API - wait 1 second between requests
-        time.sleep(1)
+        results = rg.search(list(zip(lats, lons)), mode=2)
+        return np.array([r["name"] or "Unknown" for r in results], dtype=object)
+    except ImportError:
+        pass
     
-    # Convert the list of stations into a pandas DataFrame (a table)
-    df = pd.DataFrame(all_stations)
+    print(f"   ⚠️  No city data found ({CITY_POLYGONS_FILE}, {CITY_CENTROIDS_FILE} or reverse_geocoder), cities set to 'Unknown'")
+    return np.full(len(lats), "Unknown", dtype=object)
+
+
+def geocode_cities(df):
+    """
+    Adds a city name to every station using lookup_cities().
+    Stations in the same ~100m cell share a city, so each cell is only looked up once.
+    Returns a Series of city names ("Unknown" when no match is found).
+    """
     
-    return df
+    # Work on plain NumPy arrays (much faster than going row by row)
+    lats = df["latitude"].to_numpy(dtype=float)
+    lons = df["longitude"].to_numpy(dtype=float)
+    # Skip stations without (valid) coordinates - NaN fails these checks too
+    valid = (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+    
+    city = np.full(len(df), "Unknown", dtype=object)
+    if not valid.any():
+        return pd.Series(city, index=df.index)
+    
+    # Round to 3 decimals (about 100m accuracy), shifted so the cells are never negative
+    lat_cells = np.round((lats[valid] + 90) * 1000).astype(np.int64)    # 0 to 180,000 (18 bits)
+    lon_cells = np.round((lons[valid] + 180) * 1000).astype(np.int64)   # 0 to 360,000 (19 bits)
+    
+    # Pack each cell into ONE integer (latitude in the high bits, longitude in the
+    # low 20 bits), so finding the unique cells is a plain 1-D integer sort
+    keys = (lat_cells << 20) | lon_cells
+    unique_keys, first_station, cell_of_station = np.unique(keys, return_index=True, return_inverse=True)
+    print(f"   📍 {len(unique_keys)} unique locations to look up")
+    
+    # Look up each cell once, then copy the result to every station in it
+    cell_city = lookup_cities(
+        lat_cells[first_station] / 1000 - 90,
+        lon_cells[first_station] / 1000 - 180
+    )
+    city[valid] = cell_city[cell_of_station]
+    
+    return pd.Series(city, index=df.index)
 
 
 # ===========================================
@@ -119,112 +273,65 @@ def transform_stations(df):
     - Removes duplicates
     - Standardizes operator names (Tesla vs "Tesla Motors Inc.")
     - Flags offline stations
-    - Caches geocoding results to avoid slow API calls
+    - Stores the result with compact, Arrow-backed column types
+    - Looks up city names from GPS coordinates (offline, no API calls)
     """
     
     print("\n🔧 Starting data transformation...")
     
     # STEP 1: Remove duplicate stations (same ID appearing twice)
     print(f"   Before removing duplicates: {len(df)} stations")
-    df = df.drop_duplicates(subset=["id"])
+    # Keep the last copy (pages are in order, so that's the most recently fetched one)
+    df = df.drop_duplicates(subset=["id"], keep="last", ignore_index=True)
     print(f"   After removing duplicates: {len(df)} stations")
     
     # STEP 2: Clean up operator names
     print("   Standardizing operator names...")
-    df["operator_clean"] = df["operator"].str.lower()  # Convert to lowercase
+    operator_lower = df["operator"].str.lower().fillna("")  # Convert to lowercase
     
-    # If operator contains "tesla", change it to just "Tesla"
-    df.loc[df["operator_clean"].str.contains("tesla", na=False), "operator_clean"] = "Tesla"
+    # Find "tesla", "bp" or "shell" anywhere in the name in a single pass
+    matched = operator_lower.str.extract(OPERATOR_PATTERN, expand=False)
     
-    # If operator contains "bp", change to "BP"
-    df.loc[df["operator_clean"].str.contains("bp", na=False), "operator_clean"] = "BP"
+    # Map the match to its clean name; everything else becomes "Other"
+    df["operator_clean"] = matched.map(OPERATOR_NAMES).fillna("Other")
     
-    # If operator contains "shell", change to "Shell"
-    df.loc[df["operator_clean"].str.contains("shell", na=False), "operator_clean"] = "Shell"
+    # STEP 3: Convert GPS coordinates to city names (offline, all stations at once)
+    print(f"   🔄 Geocoding {len(df)} stations offline...")
+    df["city"] = geocode_cities(df)
+    print(f"   ✅ Geocoding complete! {(df['city'] != 'Unknown').sum()} stations matched to a city")
     
-    # Everything else becomes "Other"
-    df.loc[~df["operator_clean"].isin(["tesla", "bp", "shell"]), "operator_clean"] = "Other"
-    
-    # STEP 3: Use reverse geocoding with caching (to avoid slow API calls for large datasets)
-    print("   Converting GPS coordinates to city names (cached)...")
-    
-    # Load or create geocoding cache
-    cache_file = "geocoding_cache.json"
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r') as f:
-            geocode_cache = json.load(f)
-        print(f"   📦 Loaded geocoding cache with {len(geocode_cache)} entries")
-    else:
-        geocode_cache = {}
-    
-    from geopy.geocoders import Nominatim
-    geolocator = Nominatim(user_agent="ev_pipeline_yeabsira")
-    
-    # Function to get city from latitude and longitude (with caching)
-    def get_city_cached(lat, lon):
-        # Create a cache key from the coordinates
-        key = f"{lat:.3f},{lon:.3f}"  # Round to 3 decimals (about 100m accuracy)
-        
-        # Check if we already have this cached
-        if key in geocode_cache:
-            return geocode_cache[key]
-        
-        try:
-            # Ask the geocoder: "What's at these coordinates?"
-            location = geolocator.reverse(f"{lat}, {lon}", language="en", timeout=10)
-            
-            # Get the raw address data
-            address = location.raw["address"]
-            
-            # Try to get city, if not available try town, if not available return "Unknown"
-            city = address.get("city", address.get("town", "Unknown"))
-            
-            # Cache the result
-            geocode_cache[key] = city
-            
-            # Save cache every 50 lookups to avoid losing progress
-            if len(geocode_cache) % 50 == 0:
-                with open(cache_file, 'w') as f:
-                    json.dump(geocode_cache, f)
-                print(f"   💾 Cached {len(geocode_cache)} locations")
-            
-            return city
-        except Exception as e:
-            # If something goes wrong, return "Unknown" and cache it
-            geocode_cache[key] = "Unknown"
-            return "Unknown"
-    
-    # Apply the get_city function to each row
-    # Process in batches to avoid overwhelming the server
-    print(f"   🔄 Geocoding {len(df)} stations (this may take a while)...")
-    df["city"] = df.apply(
-        lambda row: get_city_cached(row["latitude"], row["longitude"]), 
-        axis=1
-    )
-    
-    # Save the final cache
-    with open(cache_file, 'w') as f:
-        json.dump(geocode_cache, f)
-    print(f"   ✅ Geocoding complete! Total cached: {len(geocode_cache)}")
+    # Operator and city names repeat a lot - store them as categories
+    df = to_categories(df)
     
     # STEP 4: Flag offline stations
     print("   Flagging offline stations...")
     
     # Convert last_updated column to datetime format
-    df["last_updated"] = pd.to_datetime(df["last_updated"], errors='coerce')
+    # The API sends ISO 8601 dates (e.g. "2025-01-01T12:00:00Z"), so tell pandas
+    # the format instead of letting it guess for every value. "Unknown" becomes NaT.
+    df["last_updated"] = pd.to_datetime(
+        df["last_updated"], format="ISO8601", errors="coerce", utc=True, cache=True
+    )
     
-    # Get today's date
-    today = pd.Timestamp.now()
+    # Get today's date (in UTC, like the API dates)
+    today = pd.Timestamp.now(tz="UTC")
     
-    # Calculate how many days since last update
-    df["days_since_update"] = (today - df["last_updated"]).dt.days
+    # Calculate how many days since last update (empty if the date is unknown)
+    df["days_since_update"] = (today - df["last_updated"]).dt.days.astype("Int32")
     
     # Flag stations that haven't been updated in 90+ days
-    df["is_offline"] = df["days_since_update"] > 90
+    df["is_offline"] = (df["days_since_update"] > 90).fillna(False)
     
     offline_count = df['is_offline'].sum()
     print(f"   ⚠️  Found {offline_count} offline stations out of {len(df)}")
     
+    # STEP 5: Switch to compact, Arrow-backed column types
+    # (text as Arrow strings instead of Python objects, proper missing values everywhere)
+    memory_before = df.memory_usage(deep=True).sum()
+    df = df.astype({"is_offline": "boolean"}).convert_dtypes(dtype_backend="pyarrow")
+    memory_after = df.memory_usage(deep=True).sum()
+    print(f"   📉 Memory use: {memory_before / 1e6:.1f} MB -> {memory_after / 1e6:.1f} MB")
+    
     return df
 
 
@@ -260,7 +367,6 @@ if __name__ == "__main__":
     print(f"   Online stations: {(~df_clean['is_offline']).sum()}")
     print(f"   Tesla stations: {(df_clean['operator_clean'] == 'Tesla').sum()}")
     print(f"   Data saved to: charging_stations.db")
-    print(f"   Geocoding cache: geocoding_cache.json")
     print("\n🎯 Show preview of data:")
     print("-" * 50)
     pd.set_option('display.max_columns', None)